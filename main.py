@@ -1,46 +1,215 @@
-from typing import Final
+from __future__ import annotations
+
+from typing import Final, TYPE_CHECKING
 import asyncio
 import csv
 import io
-from telegram import Update
-from telegram import Bot
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from dotenv import load_dotenv
 import os
 import json
+import math
 import re
-import gspread
-from google.oauth2.service_account import Credentials
-from datetime import datetime
+import functools
+import random
+import sys
+import threading
+import codecs
+import tempfile
+import heapq
+import bisect
+import calendar
+import hashlib
+import sqlite3
+import time
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+if TYPE_CHECKING:
+    import gspread
+    from telegram import Bot, Update
+    from telegram.ext import Application, ContextTypes
 
 
 load_dotenv()
 
 scopes = [
-    "https://www.googleapis.com/auth/spreadsheets"
+    "https://www.googleapis.com/auth/spreadsheets",
+    # Only used to read the spreadsheet's modifiedTime for cache revalidation.
+    "https://www.googleapis.com/auth/drive.metadata.readonly",
 ]
+sheet_id = "14LYEWi4vJi261oTxE1HH4TxluTYcVg4zWDok8IwbJc4"
+# Access tokens are cached on disk (owner-only permissions) so short-lived cron
+# runs reuse the previous run's token instead of minting a new one each time.
+GOOGLE_TOKEN_CACHE_FILE: Final = os.environ.get("GOOGLE_TOKEN_CACHE_FILE", ".google_token_cache.json")
+TOKEN_REFRESH_MARGIN: Final = timedelta(minutes=5)
+# Client-side limit for Sheets requests; the default per-user quota is 60 requests a minute.
+SHEETS_REQUESTS_PER_MINUTE: Final = float(os.environ.get("SHEETS_REQUESTS_PER_MINUTE", "60"))
+SHEETS_BURST: Final = int(os.environ.get("SHEETS_BURST", "10"))
+SHEETS_MAX_RETRIES: Final = int(os.environ.get("SHEETS_MAX_RETRIES", "5"))
+RETRYABLE_STATUS_CODES: Final = {429, 500, 502, 503, 504}
+
+# The Google client is built on first use, so runs that never touch the sheet
+# (like an idle cron tick) skip importing gspread, building credentials and
+# opening the workbook. Telegram's libraries are likewise imported only by the
+# bot entry points, so the parsing helpers import with no network or client setup.
+_workbook: gspread.Spreadsheet | None = None
+_workbook_lock = threading.Lock()
+
+
+def load_google_credentials():
+    from google.oauth2.service_account import Credentials
+
+    # Load credentials from environment variable (Railway) or file (local)
+    # According to Railway docs: JSON should be minified (single line) with no external quotes
+    google_credentials_json = os.environ.get('GOOGLE_CREDENTIALS_JSON')
+    if google_credentials_json:
+        try:
+            creds_info = json.loads(google_credentials_json)
+            return Credentials.from_service_account_info(creds_info, scopes=scopes)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Failed to parse GOOGLE_CREDENTIALS_JSON: {e}")
+    elif os.path.exists('credentials.json'):
+        # Fall back to file for local development
+        return Credentials.from_service_account_file('credentials.json', scopes=scopes)
+    else:
+        raise ValueError(
+            "Google credentials not found. "
+            "Set GOOGLE_CREDENTIALS_JSON environment variable (minified JSON, single line) or provide credentials.json file."
+        )
+
 
-# Load credentials from environment variable (Railway) or file (local)
-# According to Railway docs: JSON should be minified (single line) with no external quotes
-google_credentials_json = os.environ.get('GOOGLE_CREDENTIALS_JSON')
-if google_credentials_json:
+def load_token_cache() -> dict:
     try:
-        creds_info = json.loads(google_credentials_json)
-        creds = Credentials.from_service_account_info(creds_info, scopes=scopes)
-    except json.JSONDecodeError as e:
-        raise ValueError(f"Failed to parse GOOGLE_CREDENTIALS_JSON: {e}")
-elif os.path.exists('credentials.json'):
-    # Fall back to file for local development
-    creds = Credentials.from_service_account_file('credentials.json', scopes=scopes)
-else:
-    raise ValueError(
-        "Google credentials not found. "
-        "Set GOOGLE_CREDENTIALS_JSON environment variable (minified JSON, single line) or provide credentials.json file."
-    )
+        if not os.path.exists(GOOGLE_TOKEN_CACHE_FILE):
+            return {}
+        with open(GOOGLE_TOKEN_CACHE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {}
 
-client = gspread.authorize(creds)
-sheet_id = "14LYEWi4vJi261oTxE1HH4TxluTYcVg4zWDok8IwbJc4"
-workbook = client.open_by_key(sheet_id)
+
+def save_token_cache(data: dict) -> None:
+    tmp_path = f"{GOOGLE_TOKEN_CACHE_FILE}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, GOOGLE_TOKEN_CACHE_FILE)
+
+
+def apply_cached_token(creds) -> None:
+    """Reuse a cached access token that is still valid, otherwise refresh it now and cache it.
+
+    A token within TOKEN_REFRESH_MARGIN of expiry is refreshed up front, so the
+    first Sheets call never waits on a token exchange mid-request.
+    """
+    from google.auth.transport.requests import Request
+
+    cache_key = f"{creds.service_account_email}|{' '.join(sorted(scopes))}"
+    now = datetime.now(timezone.utc).replace(tzinfo=None)  # google-auth uses naive UTC
+    cached = load_token_cache()
+    if cached.get("key") == cache_key and cached.get("token") and cached.get("expiry"):
+        expiry = datetime.fromisoformat(cached["expiry"])
+        if expiry - now > TOKEN_REFRESH_MARGIN:
+            creds.token = cached["token"]
+            creds.expiry = expiry
+            return
+
+    creds.refresh(Request())
+    if creds.token and creds.expiry:
+        try:
+            save_token_cache({"key": cache_key, "token": creds.token, "expiry": creds.expiry.isoformat()})
+        except OSError as e:
+            print(f"Could not cache Google access token: {e}")
+
+
+class SheetsRateLimiter:
+    """Token bucket shared by every Sheets request, sized to the per-minute quota.
+
+    A throttled or failing request also pauses the whole bucket, so the
+    other worker threads back off together instead of piling on more 429s.
+    """
+
+    def __init__(self, requests_per_minute: float, burst: int):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+sheets_rate_limiter = SheetsRateLimiter(SHEETS_REQUESTS_PER_MINUTE, SHEETS_BURST)
+
+
+def call_with_backoff(func, *args, **kwargs):
+    """Call a Sheets request through the rate limiter, retrying 429/5xx with jittered exponential backoff."""
+    for attempt in range(SHEETS_MAX_RETRIES + 1):
+        sheets_rate_limiter.acquire()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            status = getattr(getattr(e, "response", None), "status_code", None)
+            if status not in RETRYABLE_STATUS_CODES or attempt == SHEETS_MAX_RETRIES:
+                raise
+            delay = min(64, 2 ** attempt) + random.uniform(0, 1)
+            print(f"Sheets request got HTTP {status}, retrying in {delay:.1f}s.")
+            sheets_rate_limiter.pause(delay)
+
+
+def open_default_workbook() -> gspread.Spreadsheet:
+    import gspread
+    from gspread.http_client import HTTPClient
+
+    class RateLimitedHTTPClient(HTTPClient):
+        def request(self, *args, **kwargs):
+            return call_with_backoff(super().request, *args, **kwargs)
+
+    creds = load_google_credentials()
+    apply_cached_token(creds)
+    client = gspread.authorize(creds, http_client=RateLimitedHTTPClient)
+    return client.open_by_key(sheet_id)
+
+
+_workbook_factory: Callable[[], gspread.Spreadsheet] = open_default_workbook
+
+
+def set_workbook_factory(factory: Callable[[], gspread.Spreadsheet]) -> None:
+    """Replace how the workbook is opened (e.g. with a fake for tests or benchmarks).
+
+    Any workbook and worksheet handles opened by the previous factory are dropped,
+    along with the month data cached from them.
+    """
+    global _workbook, _workbook_factory
+    with _workbook_lock:
+        _workbook_factory = factory
+        _workbook = None
+    invalidate_sheet_cache()
+    forget_month_cache()
+
+
+def get_workbook() -> gspread.Spreadsheet:
+    global _workbook
+    with _workbook_lock:
+        if _workbook is None:
+            _workbook = _workbook_factory()
+        return _workbook
 
 
 TOKEN: Final = os.environ.get('TELEGRAM_BOT_TOKEN')
@@ -48,41 +217,346 @@ BOT_USERNAME: Final = os.environ.get('TELEGRAM_BOT_USERNAME', '@AlekseiFilonovSp
 ALLOWED_USER_ID: Final = os.environ.get('ALLOWED_USER_ID')
 SPENDING_DATA_FILE: Final = 'spending_data.json'
 TELEGRAM_CURSOR_FILE: Final = os.environ.get("TELEGRAM_CURSOR_FILE", "telegram_cursor.json")
+# "cron" drains pending updates once and exits; "polling" and "webhook" keep a warm Application running.
+BOT_MODE: Final = os.environ.get("BOT_MODE", "cron")
+WEBHOOK_URL: Final = os.environ.get("WEBHOOK_URL")
+WEBHOOK_LISTEN: Final = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT: Final = int(os.environ.get("PORT", "8443"))
+WEBHOOK_PATH: Final = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET_TOKEN: Final = os.environ.get("WEBHOOK_SECRET_TOKEN")
+TEMPLATE_SHEET_NAME: Final = os.environ.get("TEMPLATE_SHEET_NAME", "Template")
+# Blocking gspread calls run on this many worker threads so they never stall the event loop.
+SHEETS_MAX_WORKERS: Final = int(os.environ.get("SHEETS_MAX_WORKERS", "4"))
+# How many updates from one getUpdates page the cron drain handles at once.
+DRAIN_CONCURRENCY: Final = int(os.environ.get("DRAIN_CONCURRENCY", "8"))
+# Expenses are journaled here before they are written to the sheet, so a Sheets
+# outage delays them instead of losing them.
+OUTBOX_DB_FILE: Final = os.environ.get("OUTBOX_DB_FILE", "expense_outbox.sqlite3")
+OUTBOX_FLUSH_ATTEMPTS: Final = int(os.environ.get("OUTBOX_FLUSH_ATTEMPTS", "3"))
+# A queued expense that failed this many write attempts in total is parked: flushes skip
+# it and drains report it until it is requeued with `python main.py requeue`.
+OUTBOX_PARK_ATTEMPTS: Final = int(os.environ.get("OUTBOX_PARK_ATTEMPTS", "50"))
+# Seconds between background outbox flushes in polling/webhook mode.
+OUTBOX_FLUSH_INTERVAL: Final = float(os.environ.get("OUTBOX_FLUSH_INTERVAL", "60"))
+# Rows per updateCells request when writing the CSV block; all requests share one atomic batch_update.
+CSV_WRITE_CHUNK_ROWS: Final = int(os.environ.get("CSV_WRITE_CHUNK_ROWS", "500"))
+CSV_READ_CHUNK_BYTES: Final = 64 * 1024
+CSV_ENCODINGS: Final = ("utf-8-sig", "cp1252", "latin-1")
+# Fingerprints of the bank transactions in each sheet's R:V block, used to skip re-uploaded rows.
+CSV_IMPORT_INDEX_FILE: Final = os.environ.get("CSV_IMPORT_INDEX_FILE", "csv_import_index.json")
+SHEET_STATE_FILE: Final = os.environ.get("SHEET_STATE_FILE", "sheet_state.json")
+# Re-read column M after this many cursor-based appends to catch edits made by hand.
+APPEND_RECONCILE_INTERVAL: Final = int(os.environ.get("APPEND_RECONCILE_INTERVAL", "50"))
+# Parsed month data (M:O expenses and R:V bank rows) cached in-process and on disk.
+MONTH_CACHE_FILE: Final = os.environ.get("MONTH_CACHE_FILE", "month_cache.json")
+# A cached month is served with no API calls at all for this long after it was validated.
+MONTH_CACHE_TTL: Final = timedelta(seconds=float(os.environ.get("MONTH_CACHE_TTL_SECONDS", "30")))
+# Bumped whenever the cached structure changes, so older cache files are re-read.
+MONTH_CACHE_VERSION: Final = 3
+HISTORY_PAGE_SIZE: Final = 10
+# How long a confirmed header row is trusted before it is checked for drift again.
+HEADER_CHECK_INTERVAL: Final = timedelta(hours=float(os.environ.get("HEADER_CHECK_INTERVAL_HOURS", "24")))
+# "response" trusts the update response, "sample" also reads back a fraction of writes,
+# "readback" reads back every write (for debugging).
+SHEET_VERIFY_MODE: Final = os.environ.get("SHEET_VERIFY_MODE", "response")
+SHEET_VERIFY_SAMPLE_RATE: Final = float(os.environ.get("SHEET_VERIFY_SAMPLE_RATE", "0.05"))
+
+# Worksheet handles keyed by month name, so the tab is resolved once per process and month.
+_sheet_cache: dict[str, gspread.Worksheet] = {}
+_sheet_cache_lock = threading.RLock()
+# Expense appends claim rows from the shared cursor, so only one may run at a time.
+_expense_write_lock = threading.Lock()
+# CSV imports rewrite the R:V block, so they are serialized separately from expense appends.
+_csv_import_lock = threading.Lock()
+# Serializes read-modify-write of the sheet state file.
+_sheet_state_lock = threading.Lock()
+# Only one flusher drains the outbox at a time.
+_outbox_flush_lock = threading.Lock()
+_month_cache: dict | None = None
+_month_cache_lock = threading.RLock()
+# Data of other months' tabs read by /history, keyed by month name.
+_past_month_caches: dict[str, dict] = {}
+# Indexes derived from the month cache, by name: (month cache, its generation, index).
+# Each is rebuilt only when the cached month changes.
+_month_indexes: dict[str, tuple[dict, int, object]] = {}
+_sheets_executor = ThreadPoolExecutor(max_workers=SHEETS_MAX_WORKERS, thread_name_prefix="sheets")
+
+
+async def run_sheets(func, *args, **kwargs):
+    """Run a blocking Sheets function on the worker pool and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_sheets_executor, functools.partial(func, *args, **kwargs))
 
 
 def get_current_sheet() -> gspread.Worksheet:
     """Get the current sheet for the current month."""
-    current_month = datetime.now().strftime("%B")
-    return workbook.worksheet(current_month)
+    return get_month_sheet(datetime.now().strftime("%B"))
 
 
-def load_spending_data() -> dict:
-    """Read values from columns M and N starting at row 5, return dict mapping M5: N5."""
-    sheet = get_current_sheet()
-    
-    # Get all values from columns M and N
-    col_spending_labels = sheet.col_values(13)  # Column M
-    col_spending_amounts = sheet.col_values(14)  # Column N
+def get_month_sheet(month: str) -> gspread.Worksheet:
+    """Get the sheet named after `month` (e.g. "October"), creating it if it is missing."""
+    import gspread
 
-    
-    
-    # Slice to get values from row 5 onwards
-    spending_labels = col_spending_labels[4:] if len(col_spending_labels) > 4 else []
-    spending_amounts = col_spending_amounts[4:] if len(col_spending_amounts) > 4 else []
-    
-    # Create dictionary, filtering out empty M values
+    with _sheet_cache_lock:
+        sheet = _sheet_cache.get(month)
+        if sheet is None:
+            try:
+                sheet = get_workbook().worksheet(month)
+                provision_sheet_headers(sheet)
+            except gspread.exceptions.WorksheetNotFound:
+                sheet = create_month_sheet(month)
+                provision_sheet_headers(sheet, is_new=True)
+            _sheet_cache[month] = sheet
+        return sheet
+
+
+def find_month_sheet(month: str) -> gspread.Worksheet | None:
+    """Like get_month_sheet, but None instead of creating a missing tab."""
+    import gspread
+
+    with _sheet_cache_lock:
+        if month in _sheet_cache:
+            return _sheet_cache[month]
+        try:
+            sheet = get_workbook().worksheet(month)
+        except gspread.exceptions.WorksheetNotFound:
+            return None
+        _sheet_cache[month] = sheet
+        return sheet
+
+
+def create_month_sheet(month: str) -> gspread.Worksheet:
+    """Create a missing month tab as a copy of the template tab, or a blank one without it."""
+    import gspread
+
+    print(f"Creating sheet for {month}.")
+    workbook = get_workbook()
+    try:
+        template = workbook.worksheet(TEMPLATE_SHEET_NAME)
+    except gspread.exceptions.WorksheetNotFound:
+        return workbook.add_worksheet(title=month, rows=1000, cols=26)
+    return workbook.duplicate_sheet(template.id, new_sheet_name=month)
+
+
+def invalidate_sheet_cache() -> None:
+    with _sheet_cache_lock:
+        _sheet_cache.clear()
+
+
+# Messages of the 400 errors Sheets returns for a deleted tab: values calls cannot
+# parse its A1 range and batchUpdate cannot find its sheetId.
+MISSING_SHEET_MESSAGES: Final = ("Unable to parse range", "No grid with id")
+
+
+def is_missing_sheet_error(exc: Exception) -> bool:
+    import gspread
+
+    if isinstance(exc, gspread.exceptions.WorksheetNotFound):
+        return True
+    response = getattr(exc, "response", None)
+    status_code = getattr(response, "status_code", None)
+    if status_code == 404:
+        return True
+    if status_code == 400:
+        error = getattr(exc, "error", None)
+        message = error.get("message", "") if isinstance(error, dict) else str(exc)
+        return any(text in message for text in MISSING_SHEET_MESSAGES)
+    return False
+
+
+def invalidates_stale_sheet(func):
+    """Drop the cached worksheet when the wrapped call finds the tab gone."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if is_missing_sheet_error(e):
+                invalidate_sheet_cache()
+            raise
+    return wrapper
+
+
+EXPENSE_BLOCK_RANGE: Final = "M5:O"  # label, amount, date
+CSV_BLOCK_RANGE: Final = "R5:V"  # item, receiver, amount, date, type
+
+
+def read_ranges(sheet: gspread.Worksheet, ranges: list[str]) -> list[list[list[str]]]:
+    """Fetch several A1 ranges with one values.batchGet call."""
+    return [list(value_range) for value_range in sheet.batch_get(ranges)]
+
+
+def parse_expense_rows(rows: list[list[str]]) -> list[dict]:
+    """Turn M5:O rows into expenses with "label", "amount", "date" and sheet "row", skipping empty labels."""
     spending_values: list[dict] = []
-    for i in range(max(len(spending_labels), len(spending_amounts))):
-        label = spending_labels[i] if i < len(spending_labels) else ""
-        amount = spending_amounts[i] if i < len(spending_amounts) else ""
-      
-        # Only add to dict if label is not empty
+    for row_number, row in enumerate(rows, start=5):
+        label, amount, date = (row + ["", "", ""])[:3]
+        # Only add if label is not empty
         if label.strip():
-            spending_values.append({"amount": amount, "label": label})
-    
+            spending_values.append({"amount": amount, "label": label, "date": date, "row": row_number})
     return spending_values
 
 
+def get_sheet_revision() -> str | None:
+    """The spreadsheet's Drive modifiedTime: one small metadata call that tells whether anything changed."""
+    try:
+        return get_workbook().get_lastUpdateTime()
+    except Exception as e:
+        print(f"Could not read sheet revision: {e}")
+        return None
+
+
+def load_month_cache_file() -> dict | None:
+    try:
+        if not os.path.exists(MONTH_CACHE_FILE):
+            return None
+        with open(MONTH_CACHE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def save_month_cache_file(cache: dict) -> None:
+    tmp_path = f"{MONTH_CACHE_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, MONTH_CACHE_FILE)
+
+
+def month_cache_key(sheet: gspread.Worksheet) -> str:
+    # The spreadsheet id keeps a cache file written for one workbook from being served for another.
+    return f"{sheet.spreadsheet.id}/{sheet_state_key(sheet)}"
+
+
+@invalidates_stale_sheet
+def get_month_data() -> dict:
+    """Return the current month's parsed sheet data, served from cache whenever it is still valid.
+
+    The cache holds "expenses" (M:O), "bank" rows (R:V) and running "totals"
+    for both (see aggregate_entry). Within MONTH_CACHE_TTL it is returned as is; after
+    that it is kept if the spreadsheet revision is unchanged, and otherwise
+    both blocks are re-read with one batchGet.
+    """
+    global _month_cache
+    with _month_cache_lock:
+        sheet = get_current_sheet()
+        cache = _month_cache if _month_cache is not None else load_month_cache_file()
+        cache, changed = revalidate_month_data(sheet, cache)
+        _month_cache = cache
+        if changed:
+            save_month_cache_file(cache)
+        return cache
+
+
+@invalidates_stale_sheet
+def get_past_month_data(month: str) -> dict | None:
+    """Like get_month_data for another month's tab, cached in-process only; None when there is no such tab."""
+    with _month_cache_lock:
+        sheet = find_month_sheet(month)
+        if sheet is None:
+            return None
+        cache, _ = revalidate_month_data(sheet, _past_month_caches.get(month))
+        _past_month_caches[month] = cache
+        return cache
+
+
+def revalidate_month_data(sheet: gspread.Worksheet, cache: dict | None) -> tuple[dict, bool]:
+    """Return (month data for `sheet`, whether it changed), reusing `cache` while it is still valid."""
+    key = month_cache_key(sheet)
+    now = datetime.now()
+
+    if cache is not None and cache.get("key") == key and cache.get("version") == MONTH_CACHE_VERSION:
+        if now - datetime.fromisoformat(cache["validated_at"]) < MONTH_CACHE_TTL:
+            return cache, False
+        revision = get_sheet_revision()
+        if revision is not None and revision == cache.get("revision"):
+            cache["validated_at"] = now.isoformat()
+            return cache, True
+    else:
+        revision = get_sheet_revision()
+
+    # Read the revision before the data, so an edit in between only causes another reload.
+    expense_rows, csv_rows = read_ranges(sheet, [EXPENSE_BLOCK_RANGE, CSV_BLOCK_RANGE])
+    cache = {
+        "version": MONTH_CACHE_VERSION,
+        "key": key,
+        "revision": revision,
+        "validated_at": now.isoformat(),
+        "expenses": parse_expense_rows(expense_rows),
+        "bank": parse_csv_rows(csv_rows),
+        "totals": {"cash": new_aggregates(), "bank": new_aggregates()},
+        "generation": 0,
+    }
+    # The only full pass over the month; afterwards the totals are updated per entry.
+    for item in cache["expenses"]:
+        aggregate_expense(cache["totals"]["cash"], item)
+    for row in cache["bank"]:
+        aggregate_bank_row(cache["totals"]["bank"], row)
+    return cache, True
+
+
+def new_aggregates() -> dict:
+    return {"total": 0.0, "count": 0, "by_day": {}, "by_label": {}}
+
+
+def aggregate_entry(aggregates: dict, amount: float, date: str, label: str, sign: int = 1) -> None:
+    """Add (sign=1) or remove (sign=-1) one entry from a month's total, count and per-day/per-label sums."""
+    key = date_key(date)
+    day = format_date_key(key) if key else ""
+    aggregates["total"] += sign * amount
+    aggregates["count"] += sign
+    for bucket, bucket_key in ((aggregates["by_day"], day), (aggregates["by_label"], label)):
+        bucket[bucket_key] = bucket.get(bucket_key, 0.0) + sign * amount
+        if sign < 0 and abs(bucket[bucket_key]) < 0.005:
+            del bucket[bucket_key]
+
+
+def aggregate_expense(aggregates: dict, item: dict, sign: int = 1) -> None:
+    aggregate_entry(aggregates, parse_amount(item["amount"]), item.get("date", ""), item["label"], sign)
+
+
+def aggregate_bank_row(aggregates: dict, row: dict, sign: int = 1) -> None:
+    # Incoming money ("+" amounts) is not spending.
+    if row.get("amount", "").startswith("+"):
+        return
+    # Payments are exported as negative amounts; count them as positive spending.
+    aggregate_entry(aggregates, abs(parse_amount(row["amount"])), row.get("date", ""), row.get("receiver", ""), sign)
+
+
+def forget_month_cache() -> None:
+    """Drop the in-process month data, e.g. after a write-through that may have stopped halfway."""
+    global _month_cache
+    with _month_cache_lock:
+        _month_cache = None
+        _month_indexes.clear()
+        _past_month_caches.clear()
+
+
+def expire_month_cache(cache: dict) -> None:
+    """Make the next get_month_data re-read the sheet instead of trusting the cache."""
+    cache["validated_at"] = datetime.min.isoformat()
+
+
+def update_month_cache(sheet: gspread.Worksheet, update: Callable[[dict], None]) -> None:
+    """Apply our own sheet write to the cached month (write-through), if that month is cached.
+
+    The revision is cleared because the sheet changed, so once the TTL runs out
+    the cache is re-read and picks up anything else that changed meanwhile.
+    """
+    with _month_cache_lock:
+        # Past months are cached in-process only; re-read one after writing to it.
+        for month, past in list(_past_month_caches.items()):
+            if past.get("key") == month_cache_key(sheet):
+                del _past_month_caches[month]
+        cache = _month_cache if _month_cache is not None else load_month_cache_file()
+        if cache is None or cache.get("key") != month_cache_key(sheet) or cache.get("version") != MONTH_CACHE_VERSION:
+            return
+        update(cache)
+        cache["generation"] = cache.get("generation", 0) + 1
+        cache["revision"] = None
+        save_month_cache_file(cache)
+
+
 def is_authorized(user_id: int) -> bool:
     """Check if user is authorized to use the bot."""
     if not ALLOWED_USER_ID:
@@ -90,68 +564,345 @@ def is_authorized(user_id: int) -> bool:
     return str(user_id) == ALLOWED_USER_ID
 
 
-def add_expense(user_id: str, amount: float, label: str) -> bool:
-    """Add an expense to the first empty cell starting from row 5 in columns M and N."""
+def find_free_block(col_m: list[str], count: int, first_row: int = 5) -> int:
+    """Return the first row >= first_row where `count` consecutive M cells are empty."""
+    row = first_row
+    while True:
+        taken = next(
+            (r for r in range(row, row + count) if r <= len(col_m) and col_m[r - 1].strip()),
+            None,
+        )
+        if taken is None:
+            return row
+        row = taken + 1
+
+
+def load_sheet_state() -> dict:
     try:
-        sheet = get_current_sheet()
-        col_m = sheet.col_values(13)
-        
-        # Find first empty cell from row 5 onwards
-        if len(col_m) < 5:
-            next_row = 5
-        else:
-            empty_index = next(
-                (i for i in range(4, len(col_m)) if not col_m[i].strip()),
-                len(col_m)
+        if not os.path.exists(SHEET_STATE_FILE):
+            return {}
+        with open(SHEET_STATE_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
+
+
+def save_sheet_state(state: dict) -> None:
+    tmp_path = f"{SHEET_STATE_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, SHEET_STATE_FILE)
+
+
+def sheet_state_key(sheet: gspread.Worksheet) -> str:
+    return f"{sheet.title}:{sheet.id}"
+
+
+def find_expense_rows(sheet: gspread.Worksheet, count: int) -> tuple[int, int]:
+    """Return (start_row, appends since last reconcile) for a block of `count` expenses.
+
+    Uses the persisted next-free-row cursor and only probes the target cells.
+    Column M is downloaded again only when there is no cursor yet, the probe
+    finds the cells taken, or the periodic reconcile is due.
+    """
+    entry = load_sheet_state().get(sheet_state_key(sheet), {})
+    start_row = entry.get("next_row")
+    appends = int(entry.get("appends", 0))
+
+    if start_row is not None and appends < APPEND_RECONCILE_INTERVAL:
+        end_row = start_row + count - 1
+        taken = sheet.get(range_name=f"M{start_row}:M{end_row}")
+        if not any(row and str(row[0]).strip() for row in taken):
+            return start_row, appends
+        print(f"Row cursor conflict at M{start_row}, reconciling.")
+
+    reconciled_row = find_free_block(sheet.col_values(13), count)
+    if start_row is not None and reconciled_row != start_row:
+        print(f"Row cursor moved from {start_row} to {reconciled_row}.")
+    return reconciled_row, 0
+
+
+def update_sheet_state(sheet: gspread.Worksheet, **fields) -> None:
+    with _sheet_state_lock:
+        state = load_sheet_state()
+        state.setdefault(sheet_state_key(sheet), {}).update(fields)
+        save_sheet_state(state)
+
+
+def save_next_row(sheet: gspread.Worksheet, next_row: int, appends: int) -> None:
+    update_sheet_state(sheet, next_row=next_row, appends=appends)
+
+
+LIGHT_GREEN: Final = {"red": 0.85, "green": 0.95, "blue": 0.85}
+LIGHT_BLUE: Final = {"red": 0.8, "green": 0.9, "blue": 1.0}
+
+
+def cell_data(value: object, color: dict) -> dict:
+    """CellData carrying both the value (as RAW input would store it) and the background color."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        entered_value = {"numberValue": value}
+    else:
+        entered_value = {"stringValue": str(value)}
+    return {"userEnteredValue": entered_value, "userEnteredFormat": {"backgroundColor": color}}
+
+
+def update_cells_request(
+    sheet: gspread.Worksheet, start_row: int, start_col: int, values: list[list[object]], color: dict
+) -> dict:
+    """Build an updateCells request writing values and background color from 1-based start_row, 0-based start_col."""
+    return {
+        "updateCells": {
+            "range": {
+                "sheetId": sheet.id,
+                "startRowIndex": start_row - 1,  # 0-based, inclusive
+                "endRowIndex": start_row - 1 + len(values),  # 0-based, exclusive
+                "startColumnIndex": start_col,
+                "endColumnIndex": start_col + max(len(row) for row in values),
+            },
+            "rows": [{"values": [cell_data(value, color) for value in row]} for row in values],
+            "fields": "userEnteredValue,userEnteredFormat.backgroundColor",
+        }
+    }
+
+
+def batch_confirmed(response: dict, request_count: int) -> bool:
+    """A batch_update is applied atomically, so one reply per request confirms the write."""
+    return isinstance(response, dict) and len(response.get("replies", [])) == request_count
+
+
+def should_read_back() -> bool:
+    if SHEET_VERIFY_MODE == "readback":
+        return True
+    if SHEET_VERIFY_MODE == "sample":
+        return random.random() < SHEET_VERIFY_SAMPLE_RATE
+    return False
+
+
+def add_expenses(expenses: list[tuple[str, float, str]], month: str | None = None) -> bool:
+    """Write (label, amount, date) expenses as one contiguous block in columns M, N and O.
+
+    They go to the sheet of `month`, or of the current month when it is None.
+    The whole batch costs one cursor probe and one updateCells request that
+    carries both values and formatting, however many expenses it holds. The
+    write is confirmed from the batch_update response; SHEET_VERIFY_MODE can add
+    a read-back check.
+    """
+    if not expenses:
+        return True
+    with _expense_write_lock:
+        try:
+            sheet = get_month_sheet(month) if month else get_current_sheet()
+            start_row, appends = find_expense_rows(sheet, len(expenses))
+            end_row = start_row + len(expenses) - 1
+
+            # Write to columns M, N, and O and color them light green in the same request.
+            range_name = f"M{start_row}:O{end_row}"
+            values: list[list[object]] = [[label, amount, date] for label, amount, date in expenses]
+            response = sheet.spreadsheet.batch_update(
+                {"requests": [update_cells_request(sheet, start_row, 12, values, LIGHT_GREEN)]}  # M
             )
-            next_row = empty_index + 1
-        
-        # Write to columns M, N, and O
-        sheet.update(range_name=f"M{next_row}:O{next_row}", values=[[label, amount, datetime.now().strftime("%Y-%m-%d")]])
-
-        # Color the written range (M:O) light green.
-        sheet_id = sheet.id
-        start_row_index = next_row - 1  # 0-based, inclusive
-        end_row_index = next_row  # 0-based, exclusive
-        start_col_index = 12  # M
-        end_col_index = 15  # O (exclusive)
-        sheet.spreadsheet.batch_update(
-            {
-                "requests": [
-                    {
-                        "repeatCell": {
-                            "range": {
-                                "sheetId": sheet_id,
-                                "startRowIndex": start_row_index,
-                                "endRowIndex": end_row_index,
-                                "startColumnIndex": start_col_index,
-                                "endColumnIndex": end_col_index,
-                            },
-                            "cell": {
-                                "userEnteredFormat": {
-                                    "backgroundColor": {"red": 0.85, "green": 0.95, "blue": 0.85}
-                                }
-                            },
-                            "fields": "userEnteredFormat.backgroundColor",
-                        }
-                    }
-                ]
-            }
+        except Exception as e:
+            print(f"Failed to write {len(expenses)} expenses: {e}")
+            if is_missing_sheet_error(e):
+                invalidate_sheet_cache()
+            return False
+        if not batch_confirmed(response, 1):
+            print(f"Unexpected update response for {range_name}: {response}")
+            return False
+
+        # The rows are on the sheet now. Nothing below may report failure, or the
+        # outbox would keep the batch and write it a second time.
+        try:
+            if should_read_back() and not rows_written(sheet, start_row, end_row, len(expenses)):
+                # Do not trust the cursor or the cached month after a surprising read:
+                # the next write reconciles column M and the next read reloads the sheet.
+                update_sheet_state(sheet, next_row=None, appends=0)
+                update_month_cache(sheet, expire_month_cache)
+                return True
+
+            save_next_row(sheet, end_row + 1, appends + 1)
+
+            def append_expenses(cache: dict) -> None:
+                for row, (label, amount, date) in enumerate(expenses, start=start_row):
+                    item = {"amount": f"{amount:.2f}", "label": label, "date": date, "row": row}
+                    cache["expenses"].append(item)
+                    aggregate_expense(cache["totals"]["cash"], item)
+
+            update_month_cache(sheet, append_expenses)
+        except Exception as e:
+            print(f"Saved {range_name}, but updating the row cursor or month cache failed: {e}")
+            forget_month_cache()
+        return True
+
+
+def rows_written(sheet: gspread.Worksheet, start_row: int, end_row: int, count: int) -> bool:
+    """Verify a written batch with one read - every row needs a label and an amount."""
+    written = sheet.get(range_name=f"M{start_row}:N{end_row}")
+    confirmed = len(written) == count and all(
+        len(row) >= 2 and str(row[0]).strip() != "" and str(row[1]).strip() != ""
+        for row in written
+    )
+    if not confirmed:
+        print(f"Read-back check failed for M{start_row}:N{end_row}: {written}")
+    return confirmed
+
+
+def add_expense(user_id: str, amount: float, label: str) -> bool:
+    """Add an expense to the first empty cell starting from row 5 in columns M and N."""
+    return add_expenses([(label, amount, datetime.now().strftime("%Y-%m-%d"))])
+
+
+def open_outbox() -> sqlite3.Connection:
+    conn = sqlite3.connect(OUTBOX_DB_FILE, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            update_id INTEGER,
+            position INTEGER NOT NULL DEFAULT 0,
+            chat_id INTEGER,
+            label TEXT NOT NULL,
+            amount REAL NOT NULL,
+            date TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (update_id, position)
         )
-        
-        # Verify write succeeded - just check that something was written to the cells
-        written_label = sheet.cell(next_row, 13).value
-        written_amount = sheet.cell(next_row, 14).value
-        
-        return (written_label is not None and str(written_label).strip() != "" and
-                written_amount is not None and str(written_amount).strip() != "")
-    except Exception:
-        return False
+        """
+    )
+    return conn
+
+
+def enqueue_expenses(expenses: list[tuple[str, float, str]], chat_id: int | None, update_id: int | None) -> None:
+    """Durably record (label, amount, date) expenses in the local outbox.
+
+    Re-enqueueing the same update is a no-op, so a crash between this and
+    saving the Telegram cursor cannot double-log an expense.
+    """
+    with open_outbox() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO outbox (update_id, position, chat_id, label, amount, date) VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (update_id, position, chat_id, label, amount, date)
+                for position, (label, amount, date) in enumerate(expenses)
+            ],
+        )
+    conn.close()
+
+
+def expense_month(date: str) -> str | None:
+    """Name of the month sheet an expense dated `date` belongs to, None when the date does not parse."""
+    key = date_key(date)
+    if key == 0:
+        return None
+    return datetime(key // 10000, key // 100 % 100, 1).strftime("%B")
+
+
+def flush_outbox(wait: bool = True) -> tuple[int, int]:
+    """Write every queued expense to its month's sheet, one batch per month; return (saved, still queued).
+
+    A failed batch is retried with exponential backoff, picking up anything
+    queued in the meantime so it is written in the same batch. Parked expenses
+    (see OUTBOX_PARK_ATTEMPTS) are neither written nor counted. With wait=False
+    the call returns at once when another flush is already running; that flush
+    also writes whatever was queued while it ran.
+    """
+    if not os.path.exists(OUTBOX_DB_FILE):
+        return 0, 0
+
+    if not _outbox_flush_lock.acquire(blocking=wait):
+        return 0, count_queued_expenses()
+    try:
+        conn = open_outbox()
+        try:
+            saved = 0
+            attempt = 0
+            while True:
+                rows = conn.execute(
+                    "SELECT id, label, amount, date, attempts FROM outbox WHERE attempts < ? ORDER BY update_id, position, id",
+                    (OUTBOX_PARK_ATTEMPTS,),
+                ).fetchall()
+                if not rows:
+                    break
+                # Expenses queued before a month boundary still belong to the old month's sheet.
+                by_month: dict[str | None, list[tuple]] = {}
+                for row in rows:
+                    by_month.setdefault(expense_month(row[3]), []).append(row)
+
+                failed: list[tuple] = []
+                for month, month_rows in by_month.items():
+                    if add_expenses([(label, amount, date) for _, label, amount, date, _ in month_rows], month):
+                        with conn:
+                            conn.executemany("DELETE FROM outbox WHERE id = ?", [(row[0],) for row in month_rows])
+                        saved += len(month_rows)
+                    else:
+                        failed.extend(month_rows)
+                if not failed:
+                    attempt = 0
+                    continue
+
+                with conn:
+                    conn.executemany("UPDATE outbox SET attempts = attempts + 1 WHERE id = ?", [(row[0],) for row in failed])
+                parked = sum(1 for row in failed if row[4] + 1 >= OUTBOX_PARK_ATTEMPTS)
+                attempt += 1
+                print(f"Failed to save {len(failed)} queued expenses (attempt {attempt}).")
+                if parked:
+                    print(f"{parked} queued expenses failed {OUTBOX_PARK_ATTEMPTS} times and are parked.")
+                if attempt >= OUTBOX_FLUSH_ATTEMPTS:
+                    break
+                time.sleep(2 ** (attempt - 1))
+            queued = conn.execute(
+                "SELECT COUNT(*) FROM outbox WHERE attempts < ?", (OUTBOX_PARK_ATTEMPTS,)
+            ).fetchone()[0]
+            return saved, queued
+        finally:
+            conn.close()
+    finally:
+        _outbox_flush_lock.release()
+
+
+def count_queued_expenses() -> int:
+    conn = open_outbox()
+    try:
+        return conn.execute("SELECT COUNT(*) FROM outbox WHERE attempts < ?", (OUTBOX_PARK_ATTEMPTS,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def list_parked_expenses() -> list[tuple[str, float, str]]:
+    """(label, amount, date) of the expenses that stopped being retried."""
+    if not os.path.exists(OUTBOX_DB_FILE):
+        return []
+    conn = open_outbox()
+    try:
+        return conn.execute(
+            "SELECT label, amount, date FROM outbox WHERE attempts >= ? ORDER BY update_id, position, id",
+            (OUTBOX_PARK_ATTEMPTS,),
+        ).fetchall()
+    finally:
+        conn.close()
+
+
+def requeue_parked_expenses() -> int:
+    """Give parked expenses a fresh set of attempts; return how many were requeued."""
+    if not os.path.exists(OUTBOX_DB_FILE):
+        return 0
+    conn = open_outbox()
+    try:
+        with conn:
+            return conn.execute("UPDATE outbox SET attempts = 0 WHERE attempts >= ?", (OUTBOX_PARK_ATTEMPTS,)).rowcount
+    finally:
+        conn.close()
+
+
+EXPENSE_LINE_RE: Final = re.compile(r'(\d+(?:[.,]\d+)?)\s+(.+)')
 
 
 def parse_expense(text: str) -> tuple[float, str] | None:
     """Parse expense from text like '15 alepa' or '15.50 grocery store'."""
-    match = re.match(r'^(\d+(?:[.,]\d+)?)\s+(.+)$', text.strip())
+    match = EXPENSE_LINE_RE.fullmatch(text.strip())
     if match:
         amount = float(match.group(1).replace(',', '.'))
         description = match.group(2).strip()
@@ -159,6 +910,38 @@ def parse_expense(text: str) -> tuple[float, str] | None:
     return None
 
 
+def parse_expenses(text: str) -> tuple[list[tuple[float, str]], list[str]]:
+    """Parse one expense per line; return the (amount, label) pairs and the lines that are not expenses.
+
+    Blank lines are ignored, so a day's receipts can be pasted as one message.
+    """
+    expenses: list[tuple[float, str]] = []
+    rejected: list[str] = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        expense = parse_expense(line)
+        if expense:
+            expenses.append(expense)
+        else:
+            rejected.append(line)
+    return expenses, rejected
+
+
+def build_saved_text(expenses: list[tuple[float, str]], rejected: list[str]) -> str:
+    if len(expenses) == 1:
+        amount, label = expenses[0]
+        response = f'✅ Saved: €{amount:.2f} - {label}'
+    else:
+        lines = "\n".join(f"• €{amount:.2f} - {label}" for amount, label in expenses)
+        total = sum(amount for amount, _ in expenses)
+        response = f'✅ Saved {len(expenses)} expenses (€{total:.2f}):\n{lines}'
+    if rejected:
+        response += "\n\n❓ Skipped lines I didn't understand:\n" + "\n".join(rejected)
+    return response
+
+
 def parse_amount(amount_str: str) -> float:
     """Convert strings like '€3.00' or '3,50' to float."""
     if amount_str is None:
@@ -196,7 +979,10 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         '📖 How to use this bot:\n\n'
         '💰 Log expense: Send a number followed by description\n'
         'Example:\n'
-        '  • 15 alepa\n'    
+        '  • 15 alepa\n'
+        '  • Several at once, one per line:\n'
+        '    15 alepa\n'
+        '    4.20 coffee\n\n'    
         '📊 Commands:\n'
         '/history - View recent expenses\n'
         '/month_total - See total spending for the current month\n'
@@ -210,29 +996,29 @@ async def month_total_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     """Show total spending for the current month."""
     if not is_authorized(update.effective_user.id):
         return
-    user_id = str(update.message.chat.id)
-    data = load_spending_data()
-    
-    if len(data) == 0:
-        await update.message.reply_text('📭 No spending history yet.')
-        return
+    # Expenses acknowledged by handle_message may still be in the outbox.
+    await run_sheets(flush_outbox)
+    await update.message.reply_text(await run_sheets(build_month_total_text))
 
-    message = 'Your recent expenses:\n\n'
-    for item in data:
-        label = item["label"]
-        amount = item["amount"]
-        message += f"• {amount} - {label}\n"
 
-    total_spending = sum(parse_amount(item["amount"]) for item in data)
-    message += f"\nTotal spending this month: €{total_spending:.2f}\n"
 
-    await update.message.reply_text(message)
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show this month's expenses, a page at a time."""
+    if not is_authorized(update.effective_user.id):
+        return
+    # Expenses acknowledged by handle_message may still be in the outbox.
+    await run_sheets(flush_outbox)
+    await update.message.reply_text(await run_sheets(build_history_text, list(context.args or [])))
 
 
 
 async def edit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Edit this month's expenses."""
-    await update.message.reply_text('🔍 This feature is not available yet.')
+    if not is_authorized(update.effective_user.id):
+        return
+    # Expenses acknowledged by handle_message may still be in the outbox.
+    await run_sheets(flush_outbox)
+    await update.message.reply_text(await run_sheets(build_edit_text, list(context.args or [])))
      
 
 
@@ -245,15 +1031,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     print(f'User ({user_id}): "{text}"')
     
-    # Try to parse as expense
-    expense = parse_expense(text)
-    if expense:
-        amount, label = expense
-        success = add_expense(user_id, amount, label)
-        if not success:
-            response = '❌ Failed to save expense. Please try again.'
-        else:
-            response = f'✅ Saved: €{amount:.2f} - {label}'
+    # Try to parse as expenses, one per line
+    expenses, rejected = parse_expenses(text)
+    if expenses:
+        today = datetime.now().strftime("%Y-%m-%d")
+        # Acknowledge once the expenses are in the outbox; the sheet write happens in the background,
+        # all lines of the message in one batch.
+        enqueue_expenses([(label, amount, today) for amount, label in expenses], update.message.chat.id, update.update_id)
+        # Never wait for a flush that is already running: it would hold a Sheets worker thread idle.
+        context.application.create_task(run_sheets(flush_outbox, wait=False))
+        response = build_saved_text(expenses, rejected)
     else:
         response = (
             '❓ I didn\'t understand that.\n\n'
@@ -267,6 +1054,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_authorized(update.effective_user.id):
+        return
+    response = await import_csv_document(context.bot, update.message.document)
+    print(f'Bot: {response}')
+    await update.message.reply_text(response)
+
+
 async def error(update: Update, context: ContextTypes.DEFAULT_TYPE):
     print(f'Update {update} caused error {context.error}')
 
@@ -289,6 +1084,9 @@ def get_help_text() -> str:
         '💰 Log expense: Send a number followed by description\n'
         'Example:\n'
         '  • 15 alepa\n'
+        '  • Several at once, one per line:\n'
+        '    15 alepa\n'
+        '    4.20 coffee\n\n'
         '📊 Commands:\n'
         '/history - View recent expenses\n'
         '/month_total - See total spending for the current month\n'
@@ -298,26 +1096,260 @@ def get_help_text() -> str:
 
 
 def build_month_total_text() -> str:
-    data = load_spending_data()
-    if len(data) == 0:
+    month = get_month_data()
+    data = month["expenses"]
+    cash_totals = month["totals"]["cash"]
+    bank_totals = month["totals"]["bank"]
+    if len(data) == 0 and not bank_totals["count"]:
         return '📭 No spending history yet.'
 
-    message = 'Your recent expenses:\n\n'
-    for item in data:
-        message += f"• {item['amount']} - {item['label']}\n"
-
-    total_spending = sum(parse_amount(item["amount"]) for item in data)
-    message += f"\nTotal spending this month: €{total_spending:.2f}\n"
+    message = ''
+    if data:
+        message += 'Your recent expenses:\n\n'
+        for item in data:
+            message += f"• {item['amount']} - {item['label']}\n"
+
+        message += f"\nTotal spending this month: €{cash_totals['total']:.2f}\n"
+        today = cash_totals["by_day"].get(datetime.now().strftime("%Y-%m-%d"), 0.0)
+        if today:
+            message += f"Spent today: €{today:.2f}\n"
+        top_labels = heapq.nlargest(3, cash_totals["by_label"].items(), key=lambda item: item[1])
+        message += "Top: " + ", ".join(f"{label} €{amount:.2f}" for label, amount in top_labels) + "\n"
+    if bank_totals["count"]:
+        message += f"Bank spending this month: €{bank_totals['total']:.2f} ({bank_totals['count']} payments)\n"
     return message
 
 
-def decode_csv_bytes(csv_bytes: bytes) -> str:
-    for encoding in ("utf-8-sig", "utf-8", "cp1252", "latin-1"):
+def month_index(name: str, month: dict, build: Callable[[dict], object]):
+    with _month_cache_lock:
+        generation = month.get("generation", 0)
+        cached = _month_indexes.get(name)
+        if cached is not None and cached[0] is month and cached[1] == generation:
+            return cached[2]
+        index = build(month)
+        _month_indexes[name] = (month, generation, index)
+        return index
+
+
+def get_history_index(month: dict) -> tuple[list[int], list[dict]]:
+    """Cash expenses and bank rows of the month sorted oldest first, with a parallel list of date keys for bisect."""
+    return month_index(f"history:{month['key']}", month, build_history_index)
+
+
+def build_history_index(month: dict) -> tuple[list[int], list[dict]]:
+    entries = [
+        {"key": date_key(item.get("date", "")), "text": f"€{parse_amount(item['amount']):.2f} - {item['label']}"}
+        for item in month["expenses"]
+    ]
+    for row in month["bank"]:
+        sign = "+" if row["amount"].startswith("+") else ""
+        amount_text = f"{sign}€{abs(parse_amount(row['amount'])):.2f}"
+        entries.append({"key": date_key(row["date"]), "text": f"{amount_text} - {row['receiver'] or row['type']} (bank)"})
+    entries.sort(key=lambda e: e["key"])  # stable: cash before bank within a day
+    return [e["key"] for e in entries], entries
+
+
+def get_expense_index(month: dict) -> dict[int, dict]:
+    """Cached expenses by ID. An expense's ID is its position in the M block (row - 4), which never moves."""
+    return month_index("expenses", month, lambda m: {item["row"] - 4: item for item in m["expenses"]})
+
+
+@invalidates_stale_sheet
+def edit_expense(expense_id: int, amount: float | None, label: str | None) -> str:
+    """Correct the amount and/or label of one expense with a single targeted M:N update.
+
+    The cached row is read back first, so an entry changed on the sheet since it
+    was cached (up to MONTH_CACHE_TTL ago) is never overwritten blindly.
+    """
+    month = get_month_data()
+    item = get_expense_index(month).get(expense_id)
+    if item is None:
+        return f"❓ There is no expense #{expense_id} this month."
+
+    new_amount = amount if amount is not None else parse_amount(item["amount"])
+    new_label = label or item["label"]
+    sheet = get_current_sheet()
+    with _expense_write_lock:
         try:
-            return csv_bytes.decode(encoding)
+            (current,) = read_ranges(sheet, [f"M{item['row']}:N{item['row']}"])
+            current_label, current_amount = ((current[0] if current else []) + ["", ""])[:2]
+            if current_label != item["label"] or parse_amount(current_amount) != parse_amount(item["amount"]):
+                update_month_cache(sheet, expire_month_cache)
+                return f"⚠️ Expense #{expense_id} was changed on the sheet. Send /edit to see the current list."
+            response = sheet.spreadsheet.batch_update(
+                {"requests": [update_cells_request(sheet, item["row"], 12, [[new_label, new_amount]], LIGHT_GREEN)]}  # M
+            )
+        except Exception as e:
+            print(f"Failed to edit expense #{expense_id}: {e}")
+            if is_missing_sheet_error(e):
+                invalidate_sheet_cache()
+            response = None
+    if not batch_confirmed(response, 1):
+        return "❌ Failed to edit the expense. Please try again."
+
+    def apply_edit(cache: dict) -> None:
+        cached_item = get_expense_index(cache).get(expense_id)
+        if cached_item is None:
+            return
+        aggregate_expense(cache["totals"]["cash"], cached_item, sign=-1)
+        cached_item["amount"] = f"{new_amount:.2f}"
+        cached_item["label"] = new_label
+        aggregate_expense(cache["totals"]["cash"], cached_item)
+
+    update_month_cache(sheet, apply_edit)
+    return f"✏️ Updated #{expense_id}: €{new_amount:.2f} - {new_label}"
+
+
+def build_edit_text(args: list[str]) -> str:
+    """/edit lists recent expenses with IDs; /edit <id> <amount> [label] or /edit <id> label <text> changes one."""
+    usage = (
+        "To edit an expense, send:\n"
+        "/edit <id> <amount> [label]\n"
+        "/edit <id> label <new label>"
+    )
+    if not args:
+        expenses = get_month_data()["expenses"][-HISTORY_PAGE_SIZE:]
+        if not expenses:
+            return '📭 No spending history yet.'
+        lines = [
+            f"#{item['row'] - 4} {item.get('date', '')} €{parse_amount(item['amount']):.2f} - {item['label']}"
+            for item in reversed(expenses)
+        ]
+        return "Recent expenses:\n\n" + "\n".join(lines) + "\n\n" + usage
+
+    expense_id = args[0].lstrip("#")
+    if not expense_id.isdecimal() or len(args) < 2:
+        return usage
+    if args[1].lower() == "label":
+        if len(args) < 3:
+            return usage
+        return edit_expense(int(expense_id), None, " ".join(args[2:]))
+    try:
+        amount = parse_amount(args[1])
+    except ValueError:
+        return usage
+    if not math.isfinite(amount) or amount <= 0:
+        return "❓ The amount must be a positive number."
+    return edit_expense(int(expense_id), amount, " ".join(args[2:]) or None)
+
+
+def format_date_key(key: int) -> str:
+    if key == 0:
+        return "no date"
+    return f"{key // 10000:04d}-{key // 100 % 100:02d}-{key % 100:02d}"
+
+
+def build_history_text(args: list[str]) -> str:
+    """Page through expenses, newest first.
+
+    /history [page] pages through this month. /history before <date> and
+    /history after <date> start in the month of the date and continue into
+    neighbouring month tabs until a page is full. Each month is answered from
+    its cached data with a bisect on the date index.
+    """
+    usage = "Usage: /history [page] or /history before|after <YYYY-MM-DD>"
+    if len(args) == 2 and args[0].lower() in ("before", "after"):
+        key = date_key(args[1])
+        if key == 0:
+            return usage
+        if args[0].lower() == "before":
+            page_entries = history_before(key)
+        else:
+            page_entries = history_after(key)
+        title = f"Expenses {args[0].lower()} {format_date_key(key)}:"
+    elif len(args) <= 1 and (not args or args[0].isdecimal()):
+        keys, entries = get_history_index(get_month_data())
+        if not entries:
+            return '📭 No spending history yet.'
+        page = int(args[0]) if args else 1
+        page_count = (len(entries) + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+        if page < 1 or page > page_count:
+            return f"There are only {page_count} pages of history."
+        end = len(entries) - (page - 1) * HISTORY_PAGE_SIZE
+        page_entries = entries[max(0, end - HISTORY_PAGE_SIZE):end]
+        title = f"Expenses this month (page {page}/{page_count}):"
+        if page < page_count:
+            title += f"\nOlder: /history {page + 1}"
+    else:
+        return usage
+
+    if not page_entries:
+        return "No expenses in that range."
+    lines = [f"• {format_date_key(e['key'])} {e['text']}" for e in reversed(page_entries)]
+    return title + "\n\n" + "\n".join(lines)
+
+
+def history_months(key: int, step: int) -> Iterator[tuple[list[int], list[dict]]]:
+    """History indexes of the month of `key` and then the months before (step=-1) or after (step=1) it.
+
+    Tabs are named by month only, so at most a year of tabs is visited, and
+    never a month after the current one. Missing tabs are skipped.
+    """
+    now = datetime.now()
+    year, month = key // 10000, key // 100 % 100
+    titles: set[str] | None = None
+    for _ in range(12):
+        if (year, month) > (now.year, now.month):
+            return
+        name = datetime(year, month, 1).strftime("%B")
+        if (year, month) == (now.year, now.month):
+            yield get_history_index(get_month_data())
+        else:
+            if titles is None:
+                # One metadata call tells which of the month tabs exist.
+                titles = {worksheet.title for worksheet in get_workbook().worksheets()}
+            data = get_past_month_data(name) if name in titles else None
+            if data is not None:
+                yield get_history_index(data)
+        month += step
+        if month == 0:
+            year, month = year - 1, 12
+        elif month == 13:
+            year, month = year + 1, 1
+
+
+def history_before(key: int) -> list[dict]:
+    """Up to HISTORY_PAGE_SIZE entries dated before `key`, oldest first."""
+    page_entries: list[dict] = []
+    for keys, entries in history_months(key, -1):
+        end = bisect.bisect_left(keys, key)
+        page_entries = entries[max(0, end - (HISTORY_PAGE_SIZE - len(page_entries))):end] + page_entries
+        if len(page_entries) >= HISTORY_PAGE_SIZE:
+            break
+    return page_entries
+
+
+def history_after(key: int) -> list[dict]:
+    """Up to HISTORY_PAGE_SIZE entries dated after `key`, oldest first."""
+    page_entries: list[dict] = []
+    for keys, entries in history_months(key, 1):
+        start = bisect.bisect_right(keys, key)
+        page_entries += entries[start:start + HISTORY_PAGE_SIZE - len(page_entries)]
+        if len(page_entries) >= HISTORY_PAGE_SIZE:
+            break
+    return page_entries
+
+
+def detect_csv_encoding(csv_file) -> str:
+    """Return the first encoding that decodes the whole binary file, reading it in chunks."""
+    for encoding in CSV_ENCODINGS:
+        csv_file.seek(0)
+        decoder = codecs.getincrementaldecoder(encoding)()
+        try:
+            while chunk := csv_file.read(CSV_READ_CHUNK_BYTES):
+                decoder.decode(chunk)
+            decoder.decode(b"", final=True)
+            return encoding
         except UnicodeDecodeError:
             continue
-    return csv_bytes.decode("utf-8", errors="replace")
+    return "latin-1"
+
+
+def open_csv_text(csv_file) -> io.TextIOWrapper:
+    """Wrap a binary CSV file in an incrementally decoding text stream."""
+    encoding = detect_csv_encoding(csv_file)
+    csv_file.seek(0)
+    return io.TextIOWrapper(csv_file, encoding=encoding, newline="")
 
 
 def list_spendings_from_csv(csv_text: str) -> list[str]:
@@ -339,9 +1371,9 @@ def list_spendings_from_csv(csv_text: str) -> list[str]:
     return spendings
 
 
-def parse_csv_spendings(csv_text: str) -> list[dict[str, str]]:
-    reader = csv.DictReader(io.StringIO(csv_text), delimiter=";")
-    spendings: list[dict[str, str]] = []
+def iter_csv_spendings(csv_lines: Iterable[str]) -> Iterator[dict[str, str]]:
+    """Yield spendings one row at a time from the lines of a bank statement CSV."""
+    reader = csv.DictReader(csv_lines, delimiter=";")
 
     for row in reader:
         amount_raw = (row.get("Summa") or "").strip()
@@ -352,35 +1384,119 @@ def parse_csv_spendings(csv_text: str) -> list[dict[str, str]]:
         amount_value = abs(parse_amount(amount_raw))
         amount_formatted = f"+{amount_value:.2f}" if is_income else f"{amount_value:.2f}"
 
-        spendings.append(
-            {
-                "date": (row.get("Kirjauspäivä") or "").strip(),
-                "amount": amount_formatted,
-                "type": (row.get("Tapahtumalaji") or "").strip(),
-                "receiver": (row.get("Saajan nimi") or "").strip(),
-            }
-        )
+        yield {
+            "date": (row.get("Kirjauspäivä") or "").strip(),
+            "amount": amount_formatted,
+            "type": (row.get("Tapahtumalaji") or "").strip(),
+            "receiver": (row.get("Saajan nimi") or "").strip(),
+            "reference": (row.get("Arkistointitunnus") or "").strip().strip("-"),
+        }
 
-    return spendings
+
+def parse_csv_spendings(csv_text: str) -> list[dict[str, str]]:
+    return list(iter_csv_spendings(io.StringIO(csv_text)))
+
+
+def transaction_fingerprint(spending: dict[str, str], occurrence: int) -> str:
+    """Fingerprint a bank transaction by date, amount, receiver, type and bank reference.
+
+    `occurrence` numbers identical rows without a reference within one
+    statement, so genuine repeats are kept while a re-upload still matches.
+    """
+    key = "\x1f".join(
+        [
+            spending.get("date", ""),
+            spending.get("amount", ""),
+            spending.get("receiver", ""),
+            spending.get("type", ""),
+            spending.get("reference", "") or f"#{occurrence}",
+        ]
+    )
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:20]
+
+
+def transaction_base(row: dict[str, str]) -> str:
+    """Fingerprint of what the R:V block itself stores for a transaction: date, amount, receiver and type."""
+    key = "\x1f".join(row.get(field, "").strip() for field in ("date", "amount", "receiver", "type"))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:20]
 
 
-def parse_sheet_date(date_str: str) -> datetime:
+def load_import_index() -> dict[str, dict[str, list[str]]]:
+    """Per sheet (see sheet_state_key): transaction_base -> fingerprints of the sheet rows with that base."""
+    try:
+        if not os.path.exists(CSV_IMPORT_INDEX_FILE):
+            return {}
+        with open(CSV_IMPORT_INDEX_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data.get("sheets", {})
+    except Exception:
+        return {}
+
+
+def save_import_index(index: dict[str, dict[str, list[str]]]) -> None:
+    tmp_path = f"{CSV_IMPORT_INDEX_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"sheets": index}, f)
+    os.replace(tmp_path, CSV_IMPORT_INDEX_FILE)
+
+
+def reconcile_import_index(entries: dict[str, list[str]], existing: list[dict[str, str]]) -> dict[str, list[str]]:
+    """Match a sheet's index to the rows its R:V block holds now.
+
+    Each base keeps one fingerprint per sheet row with that base: fingerprints
+    of deleted rows are dropped, and rows the index does not know (imported
+    before the index existed, or typed in by hand) get an "" placeholder that
+    the first matching upload claims.
+    """
+    counts: dict[str, int] = {}
+    for row in existing:
+        base = transaction_base(row)
+        counts[base] = counts.get(base, 0) + 1
+    reconciled: dict[str, list[str]] = {}
+    for base, count in counts.items():
+        known = entries.get(base, [])[:count]
+        reconciled[base] = known + [""] * (count - len(known))
+    return reconciled
+
+
+@functools.lru_cache(maxsize=4096)
+def date_key(date_str: str) -> int:
+    """Sortable yyyymmdd integer for a sheet date, 0 when it does not parse.
+
+    Cached per distinct string: bank exports repeat the same few dates over
+    and over. The zero-padded dd.mm.yyyy and yyyy-mm-dd layouts are read
+    straight from the string; anything else goes through strptime.
+    """
     cleaned = (date_str or "").strip()
     if not cleaned:
-        return datetime.min
-    for fmt in ("%d.%m.%Y", "%Y-%m-%d"):
-        try:
-            return datetime.strptime(cleaned, fmt)
-        except ValueError:
-            continue
-    return datetime.min
+        return 0
+    if len(cleaned) == 10 and cleaned[2] == cleaned[5] == "." and cleaned.replace(".", "").isdecimal():
+        year, month, day = int(cleaned[6:]), int(cleaned[3:5]), int(cleaned[:2])
+    elif len(cleaned) == 10 and cleaned[4] == cleaned[7] == "-" and cleaned.replace("-", "").isdecimal():
+        year, month, day = int(cleaned[:4]), int(cleaned[5:7]), int(cleaned[8:])
+    else:
+        for fmt in ("%d.%m.%Y", "%Y-%m-%d"):
+            try:
+                parsed = datetime.strptime(cleaned, fmt)
+            except ValueError:
+                continue
+            return parsed.year * 10000 + parsed.month * 100 + parsed.day
+        return 0
+    if not (1 <= month <= 12 and 1 <= day <= calendar.monthrange(year, month)[1]) or year < 1:
+        return 0
+    return year * 10000 + month * 100 + day
 
 
 def load_existing_csv_rows(sheet: gspread.Worksheet) -> list[dict[str, str]]:
-    rows = sheet.get(range_name="R5:V")
+    """Read the R:V block; each row also records the sheet "row" it was read from."""
+    (csv_rows,) = read_ranges(sheet, [CSV_BLOCK_RANGE])
+    return parse_csv_rows(csv_rows)
+
+
+def parse_csv_rows(rows: list[list[str]]) -> list[dict[str, str]]:
     existing: list[dict[str, str]] = []
 
-    for row in rows:
+    for row_number, row in enumerate(rows, start=5):
         padded = (row + ["", "", "", "", ""])[:5]
         item, receiver, amount, date, type_ = (cell.strip() for cell in padded)
 
@@ -388,63 +1504,96 @@ def load_existing_csv_rows(sheet: gspread.Worksheet) -> list[dict[str, str]]:
             continue
 
         existing.append(
-            {"item": item, "receiver": receiver, "amount": amount, "date": date, "type": type_}
+            {"item": item, "receiver": receiver, "amount": amount, "date": date, "type": type_, "row": row_number}
         )
 
     return existing
 
 
-def write_csv_rows_sorted(sheet: gspread.Worksheet, rows: list[dict[str, str]]) -> None:
-    values: list[list[object]] = []
-    for r in rows:
-        values.append([r.get("item", ""), r.get("receiver", ""), r.get("amount", ""), r.get("date", ""), r.get("type", "")])
-
-    if len(values) == 0:
+def write_csv_rows_sorted(
+    sheet: gspread.Worksheet,
+    rows: list[dict[str, str]],
+    start_row: int = 5,
+    previous_last_row: int = 4,
+) -> None:
+    """Write rows to R:V from start_row down and clear old rows below them up to previous_last_row."""
+    if len(rows) == 0:
         return
 
-    start_row = 5
-    end_row = start_row + len(values) - 1
-    sheet.update(range_name=f"R{start_row}:V{end_row}", values=values)
+    end_row = start_row + len(rows) - 1
+
+    # Each chunk is one updateCells request carrying values and the light blue color together.
+    # All of them go in a single batch_update, which is applied atomically: rows shifted down
+    # by a merge are never half-written if the call fails.
+    requests: list[dict] = []
+    for offset in range(0, len(rows), CSV_WRITE_CHUNK_ROWS):
+        chunk = rows[offset:offset + CSV_WRITE_CHUNK_ROWS]
+        values: list[list[object]] = [
+            [r.get("item", ""), r.get("receiver", ""), r.get("amount", ""), r.get("date", ""), r.get("type", "")]
+            for r in chunk
+        ]
+        requests.append(update_cells_request(sheet, start_row + offset, 17, values, LIGHT_BLUE))  # R
 
     # Clear any leftover old rows below, so deleted rows don't linger.
-    col_s = sheet.col_values(19)  # S (Receiver)
-    previous_last_row = max(4, len(col_s))
     if previous_last_row > end_row:
-        sheet.update(
-            range_name=f"R{end_row + 1}:V{previous_last_row}",
-            values=[["", "", "", "", ""] for _ in range(previous_last_row - end_row)],
+        requests.append(
+            {
+                "updateCells": {
+                    "range": {
+                        "sheetId": sheet.id,
+                        "startRowIndex": end_row,  # first row after the block, 0-based
+                        "endRowIndex": previous_last_row,
+                        "startColumnIndex": 17,  # R
+                        "endColumnIndex": 22,  # V (exclusive)
+                    },
+                    "fields": "userEnteredValue",
+                }
+            }
         )
+    sheet.spreadsheet.batch_update({"requests": requests})
+
+
+def cache_bank_rows(sheet: gspread.Worksheet, rows: list[dict[str, str]], added: list[dict[str, str]]) -> None:
+    """Write-through for the R:V block, which now holds `rows` compacted from row 5, `added` being new."""
+    def replace_bank_rows(cache: dict) -> None:
+        cache["bank"] = [{**r, "row": row} for row, r in enumerate(rows, start=5)]
+        for r in added:
+            aggregate_bank_row(cache["totals"]["bank"], r)
+
+    update_month_cache(sheet, replace_bank_rows)
 
-    # Color the written range (R:V) light blue.
-    light_blue = {"red": 0.8, "green": 0.9, "blue": 1.0}
-    sheet_id = sheet.id
-    sheet.spreadsheet.batch_update(
-        {
-            "requests": [
-                {
-                    "repeatCell": {
-                        "range": {
-                            "sheetId": sheet_id,
-                            "startRowIndex": start_row - 1,  # 0-based
-                            "endRowIndex": end_row,
-                            "startColumnIndex": 17,  # R
-                            "endColumnIndex": 22,  # V (exclusive)
-                        },
-                        "cell": {"userEnteredFormat": {"backgroundColor": light_blue}},
-                        "fields": "userEnteredFormat.backgroundColor",
-                    }
-                }
-            ]
-        }
-    )
 
+@invalidates_stale_sheet
+def add_and_sort_csv_spendings_to_sheet(new_spendings: Iterable[dict[str, str]]) -> tuple[int, int]:
+    """Add bank transactions to the R:V block and return (added, skipped as already imported)."""
+    with _csv_import_lock:
+        return _add_and_sort_csv_spendings(new_spendings)
 
-def add_and_sort_csv_spendings_to_sheet(new_spendings: list[dict[str, str]]) -> int:
+
+def _add_and_sort_csv_spendings(new_spendings: Iterable[dict[str, str]]) -> tuple[int, int]:
     sheet = get_current_sheet()
     existing = load_existing_csv_rows(sheet)
+    index = load_import_index()
+    # The sheet is the source of truth: rows deleted from it can be imported again.
+    entries = reconcile_import_index(index.get(sheet_state_key(sheet), {}), existing)
+    occurrences: dict[str, int] = {}
+    skipped = 0
 
     incoming_rows: list[dict[str, str]] = []
     for item in new_spendings:
+        first = transaction_fingerprint(item, 0)
+        occurrences[first] = occurrences.get(first, 0) + 1
+        fingerprint = transaction_fingerprint(item, occurrences[first])
+        known = entries.setdefault(transaction_base(item), [])
+        if fingerprint in known:
+            skipped += 1
+            continue
+        if "" in known:
+            # The same transaction is already on the sheet but was never fingerprinted.
+            known[known.index("")] = fingerprint
+            skipped += 1
+            continue
+        known.append(fingerprint)
         incoming_rows.append(
             {
                 "item": "",  # keep empty for manual input
@@ -455,19 +1604,76 @@ def add_and_sort_csv_spendings_to_sheet(new_spendings: list[dict[str, str]]) ->
             }
         )
 
-    merged = existing + incoming_rows
-    merged.sort(key=lambda r: parse_sheet_date(r.get("date", "")))
+    index[sheet_state_key(sheet)] = {base: known for base, known in entries.items() if known}
+    if not incoming_rows:
+        save_import_index(index)
+        return 0, skipped
+
+    def row_date_key(r: dict[str, str]) -> int:
+        return date_key(r.get("date", ""))
+
+    incoming_rows.sort(key=row_date_key)
+    previous_last_row = existing[-1]["row"] if existing else 4
+    is_compact = previous_last_row == 4 + len(existing)
+    is_sorted = all(row_date_key(a) <= row_date_key(b) for a, b in zip(existing, existing[1:]))
+
+    if not (is_compact and is_sorted):
+        # Gaps or hand-edited dates: fall back to sorting and rewriting the whole block.
+        merged = sorted(existing + incoming_rows, key=row_date_key)
+        write_csv_rows_sorted(sheet, merged, previous_last_row=previous_last_row)
+        save_import_index(index)
+        cache_bank_rows(sheet, merged, incoming_rows)
+        return len(incoming_rows), skipped
+
+    # Merge the sorted incoming rows into the sorted block. Existing rows win ties,
+    # and everything above the first inserted row stays where it is on the sheet.
+    merged = list(heapq.merge(existing, incoming_rows, key=row_date_key))
+    first_changed = next(
+        (i for i, (old, new) in enumerate(zip(existing, merged)) if old is not new),
+        len(existing),
+    )
+    write_csv_rows_sorted(sheet, merged[first_changed:], start_row=5 + first_changed)
+    save_import_index(index)
+    cache_bank_rows(sheet, merged, incoming_rows)
+    return len(incoming_rows), skipped
 
-    write_csv_rows_sorted(sheet, merged)
-    return len(incoming_rows)
 
+# Header values written by ensure_sheet_headers, used to detect drift.
+EXPENSE_HEADERS: Final = ["Expenses in cash"]
+CSV_HEADERS: Final = ["Item", "Receiver", "Amount", "Date", "Type"]
+
+
+def headers_in_place(sheet: gspread.Worksheet) -> bool:
+    """Cheap drift check: one read of the header ranges in row 4."""
+    expense_header, csv_header = read_ranges(sheet, ["M4", "R4:V4"])
+    return (
+        (expense_header[0] if expense_header else []) == EXPENSE_HEADERS
+        and (csv_header[0] if csv_header else []) == CSV_HEADERS
+    )
 
-def ensure_sheet_headers() -> None:
-    sheet = get_current_sheet()
-    sheet_id = sheet.id
 
-    light_green = {"red": 0.85, "green": 0.95, "blue": 0.85}
-    light_blue = {"red": 0.8, "green": 0.9, "blue": 1.0}
+def provision_sheet_headers(sheet: gspread.Worksheet, is_new: bool = False) -> None:
+    """Write the headers only for a new sheet or when they drifted.
+
+    A sheet whose headers were confirmed within HEADER_CHECK_INTERVAL costs
+    no Sheets calls at all; after that one read checks them again.
+    """
+    entry = load_sheet_state().get(sheet_state_key(sheet), {})
+    checked_at = entry.get("headers_checked_at")
+    if not is_new and checked_at and datetime.now() - datetime.fromisoformat(checked_at) < HEADER_CHECK_INTERVAL:
+        return
+
+    if is_new or not headers_in_place(sheet):
+        print(f"Writing headers for {sheet.title}.")
+        ensure_sheet_headers(sheet)
+    update_sheet_state(sheet, headers_checked_at=datetime.now().isoformat(timespec="seconds"))
+
+
+@invalidates_stale_sheet
+def ensure_sheet_headers(sheet: gspread.Worksheet | None = None) -> None:
+    if sheet is None:
+        sheet = get_current_sheet()
+    sheet_id = sheet.id
 
     sheet.spreadsheet.batch_update(
         {
@@ -481,7 +1687,7 @@ def ensure_sheet_headers() -> None:
                             "startColumnIndex": 12,  # M
                             "endColumnIndex": 15,  # O (exclusive)
                         },
-                        "cell": {"userEnteredFormat": {"backgroundColor": light_green}},
+                        "cell": {"userEnteredFormat": {"backgroundColor": LIGHT_GREEN}},
                         "fields": "userEnteredFormat.backgroundColor",
                     }
                 },
@@ -524,35 +1730,35 @@ def ensure_sheet_headers() -> None:
                                     {
                                         "userEnteredValue": {"stringValue": "Item"},
                                         "userEnteredFormat": {
-                                            "backgroundColor": light_blue,
+                                            "backgroundColor": LIGHT_BLUE,
                                             "textFormat": {"bold": True},
                                         },
                                     },
                                     {
                                         "userEnteredValue": {"stringValue": "Receiver"},
                                         "userEnteredFormat": {
-                                            "backgroundColor": light_blue,
+                                            "backgroundColor": LIGHT_BLUE,
                                             "textFormat": {"bold": True},
                                         },
                                     },
                                     {
                                         "userEnteredValue": {"stringValue": "Amount"},
                                         "userEnteredFormat": {
-                                            "backgroundColor": light_blue,
+                                            "backgroundColor": LIGHT_BLUE,
                                             "textFormat": {"bold": True},
                                         },
                                     },
                                     {
                                         "userEnteredValue": {"stringValue": "Date"},
                                         "userEnteredFormat": {
-                                            "backgroundColor": light_blue,
+                                            "backgroundColor": LIGHT_BLUE,
                                             "textFormat": {"bold": True},
                                         },
                                     },
                                     {
                                         "userEnteredValue": {"stringValue": "Type"},
                                         "userEnteredFormat": {
-                                            "backgroundColor": light_blue,
+                                            "backgroundColor": LIGHT_BLUE,
                                             "textFormat": {"bold": True},
                                         },
                                     },
@@ -604,7 +1810,41 @@ def save_last_update_id(last_update_id: int) -> None:
     os.replace(tmp_path, TELEGRAM_CURSOR_FILE)
 
 
+def import_csv_file(csv_file) -> tuple[int, int]:
+    with open_csv_text(csv_file) as csv_lines:
+        return add_and_sort_csv_spendings_to_sheet(iter_csv_spendings(csv_lines))
+
+
+async def import_csv_document(bot: Bot, document) -> str:
+    """Download a CSV bank statement, add its rows to the sheet and return the reply text.
+
+    The statement is spooled to a temporary file and parsed row by row from
+    there, so no decoded copy of the whole file is kept in memory.
+    """
+    tg_file = await bot.get_file(document.file_id)
+    with tempfile.TemporaryFile() as csv_file:
+        await tg_file.download_to_memory(out=csv_file)
+        uploaded_count, skipped_count = await run_sheets(import_csv_file, csv_file)
+    if uploaded_count == 0 and skipped_count == 0:
+        return "CSV received, but no spendings found."
+    if uploaded_count == 0:
+        return f"CSV received, but all {skipped_count} rows were already uploaded."
+    return (
+        f"Successfully uploaded the csv to Google Sheets. "
+        f"({uploaded_count} new rows, {skipped_count} duplicates skipped)"
+    )
+
+
+# Commands answered from the sheet; in a drain they wait for the expenses sent before them.
+READ_COMMANDS: Final = frozenset({"/month_total", "/history", "/edit"})
+
+
+def message_command(text: str) -> str:
+    return text.strip().split()[0] if text.strip().startswith("/") else ""
+
+
 async def process_update(bot: Bot, update: Update) -> bool:
+    """Handle one update; return True when it queued an expense in the outbox."""
     if not update.message:
         return False
 
@@ -614,20 +1854,9 @@ async def process_update(bot: Bot, update: Update) -> bool:
     chat_id = update.message.chat_id
 
     if update.message.document and update.message.document.file_name:
-        file_name = update.message.document.file_name.strip()
-        if file_name.lower().endswith(".csv"):
-            tg_file = await bot.get_file(update.message.document.file_id)
-            csv_bytes = await tg_file.download_as_bytearray()
-            csv_text = decode_csv_bytes(bytes(csv_bytes))
-            spendings = parse_csv_spendings(csv_text)
-            uploaded_count = add_and_sort_csv_spendings_to_sheet(spendings)
-            if uploaded_count == 0:
-                await bot.send_message(chat_id=chat_id, text="CSV received, but no spendings found.")
-            else:
-                await bot.send_message(
-                    chat_id=chat_id,
-                    text=f"Successfully uploaded the csv to Google Sheets. ({uploaded_count} rows)",
-                )
+        if update.message.document.file_name.strip().lower().endswith(".csv"):
+            response = await import_csv_document(bot, update.message.document)
+            await bot.send_message(chat_id=chat_id, text=response)
             return False
 
     if not update.message.text:
@@ -637,28 +1866,29 @@ async def process_update(bot: Bot, update: Update) -> bool:
 
     print(f'User ({chat_id}): "{text}"')
 
-    command = text.strip().split()[0] if text.strip().startswith("/") else ""
-    if command in {"/start", "/help", "/month_total", "/edit"}:
+    command = message_command(text)
+    if command in {"/start", "/help"} | READ_COMMANDS:
         if command == "/start":
             response = get_start_text()
         elif command == "/help":
             response = get_help_text()
         elif command == "/month_total":
-            response = build_month_total_text()
+            response = await run_sheets(build_month_total_text)
+        elif command == "/history":
+            response = await run_sheets(build_history_text, text.split()[1:])
         else:
-            response = "🔍 This feature is not available yet."
+            response = await run_sheets(build_edit_text, text.split()[1:])
 
         print(f"Bot: {response}")
         await bot.send_message(chat_id=chat_id, text=response)
         return False
 
-    expense = parse_expense(text)
-    if expense:
-        amount, label = expense
-        success = add_expense(str(chat_id), amount, label)
-        if not success:
-            print("Failed to save expense.")
-            return False
+    expenses, rejected = parse_expenses(text)
+    if expenses:
+        today = datetime.now().strftime("%Y-%m-%d")
+        enqueue_expenses([(label, amount, today) for amount, label in expenses], chat_id, update.update_id)
+        if rejected:
+            await bot.send_message(chat_id=chat_id, text="❓ Skipped lines I didn't understand:\n" + "\n".join(rejected))
         return True
     else:
         print("Unrecognized message format.")
@@ -666,34 +1896,158 @@ async def process_update(bot: Bot, update: Update) -> bool:
 
 
 async def run_cron_drain() -> None:
+    from telegram import Bot
+
     if not TOKEN:
         raise ValueError("TELEGRAM_BOT_TOKEN is not set")
 
     bot = Bot(token=TOKEN)
-    ensure_sheet_headers()
     last_update_id = load_last_update_id()
     last_spending_chat_id: int | None = None
-    saved_any_spending = False
+
+    semaphore = asyncio.Semaphore(DRAIN_CONCURRENCY)
+
+    async def handle(upd: Update, earlier: list[asyncio.Future]) -> bool:
+        if upd.message and upd.message.text and message_command(upd.message.text) in READ_COMMANDS:
+            # Answer from a sheet that already holds every expense sent before this command.
+            if earlier:
+                await asyncio.wait(earlier)
+            await run_sheets(flush_outbox)
+        async with semaphore:
+            return await process_update(bot, upd)
 
     while True:
         updates = await bot.get_updates(offset=last_update_id + 1, timeout=0)
         if not updates:
             break
 
+        # Handle the whole page concurrently. The cursor only moves past an update
+        # once it and every update before it on the page have completed.
+        futures: list[asyncio.Future] = []
         for upd in updates:
-            last_update_id = max(last_update_id, int(upd.update_id))
-            try:
-                saved_spending = await process_update(bot, upd)
-                if saved_spending and upd.message:
+            futures.append(asyncio.ensure_future(handle(upd, list(futures))))
+        tasks = dict(zip(futures, updates))
+        completed: set[int] = set()
+        next_index = 0
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                upd = tasks[task]
+                completed.add(int(upd.update_id))
+                if task.exception() is not None:
+                    print(f"Update {upd.update_id} caused error {task.exception()}")
+                elif task.result() and upd.message:
                     last_spending_chat_id = upd.message.chat_id
-                    saved_any_spending = True
-            finally:
+
+            previous_update_id = last_update_id
+            while next_index < len(updates) and int(updates[next_index].update_id) in completed:
+                last_update_id = max(last_update_id, int(updates[next_index].update_id))
+                next_index += 1
+            if last_update_id != previous_update_id:
                 save_last_update_id(last_update_id)
 
-    if saved_any_spending and last_spending_chat_id is not None:
+    # Write everything queued in the outbox, including leftovers from earlier runs, in one batch.
+    saved_count, queued_count = await run_sheets(flush_outbox)
+    if queued_count:
+        print(f"{queued_count} expenses are still queued.")
+
+    parked = await run_sheets(list_parked_expenses)
+    if parked:
+        print(f"{len(parked)} expenses are parked.")
+
+    if last_spending_chat_id is None:
+        return
+    if queued_count == 0 and not parked:
         await bot.send_message(chat_id=last_spending_chat_id, text="All spendings are saved!")
+    elif queued_count:
+        await bot.send_message(
+            chat_id=last_spending_chat_id,
+            text=f"⏳ {queued_count} spendings are queued and will be saved on the next run.",
+        )
+    if parked:
+        lines = "\n".join(f"• €{amount:.2f} - {label} ({date})" for label, amount, date in parked)
+        await bot.send_message(
+            chat_id=last_spending_chat_id,
+            text=f"⚠️ {len(parked)} spendings could not be saved after repeated attempts and are no longer retried:\n"
+            f"{lines}\n\nFix the sheet, then run `python main.py requeue` to retry them.",
+        )
+
+
+async def run_outbox_flusher() -> None:
+    """Retry queued expenses periodically, so an outage is caught up without new messages."""
+    while True:
+        await asyncio.sleep(OUTBOX_FLUSH_INTERVAL)
+        try:
+            await run_sheets(flush_outbox, wait=False)
+        except Exception as e:
+            print(f"Outbox flush failed: {e}")
+
+
+async def on_startup(application: Application) -> None:
+    # Resolve the month sheet (and provision its headers) before the first update arrives.
+    await run_sheets(get_current_sheet)
+    application.bot_data["outbox_flusher"] = asyncio.create_task(run_outbox_flusher())
+    await run_sheets(flush_outbox, wait=False)
+
+
+async def on_shutdown(application: Application) -> None:
+    flusher = application.bot_data.pop("outbox_flusher", None)
+    if flusher is not None:
+        flusher.cancel()
+
+
+def build_application() -> Application:
+    from telegram.ext import Application, CommandHandler, MessageHandler, filters
+
+    application = Application.builder().token(TOKEN).post_init(on_startup).post_stop(on_shutdown).build()
+    # Only new messages: edited messages would reach the handlers with update.message set to None.
+    new_message = filters.UpdateType.MESSAGE
+    application.add_handler(CommandHandler("start", start_command, filters=new_message))
+    application.add_handler(CommandHandler("help", help_command, filters=new_message))
+    application.add_handler(CommandHandler("month_total", month_total_command, filters=new_message))
+    application.add_handler(CommandHandler("history", history_command, filters=new_message))
+    application.add_handler(CommandHandler("edit", edit_command, filters=new_message))
+    application.add_handler(MessageHandler(new_message & filters.Document.FileExtension("csv"), handle_document))
+    application.add_handler(MessageHandler(new_message & filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_error_handler(error)
+    return application
+
+
+def run_server(mode: str) -> None:
+    """Keep the bot running, receiving updates by long polling or through a webhook.
+
+    The webhook listens on WEBHOOK_LISTEN:PORT (localhost by default, for use
+    behind a reverse proxy) and registers WEBHOOK_URL with Telegram.
+    """
+    from telegram import Update
+
+    if not TOKEN:
+        raise ValueError("TELEGRAM_BOT_TOKEN is not set")
+
+    application = build_application()
+    if mode == "webhook":
+        if not WEBHOOK_URL:
+            raise ValueError("WEBHOOK_URL is not set")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == '__main__':
-    print("Running cron drain...")
-    asyncio.run(run_cron_drain())
+    mode = sys.argv[1] if len(sys.argv) > 1 else BOT_MODE
+    if mode in ("polling", "webhook"):
+        print(f"Running {mode} server...")
+        run_server(mode)
+    elif mode == "requeue":
+        print(f"Requeued {requeue_parked_expenses()} parked expenses.")
+    else:
+        print("Running cron drain...")
+        asyncio.run(run_cron_drain())